@@ -1,11 +1,16 @@
 import time
 
 from matplotlib import pyplot as plt
-from scipy.linalg import solve
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.special import bessel_j0
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 from fealpy.ml.modules import Solution
 from uniformly_placed import sample_points_on_square
 from fealpy.ml.sampler import ISampler
@@ -24,25 +29,67 @@ from fealpy.ml.sampler import ISampler
 num_of_col_bd = 5000
 num_of_source = 5000
 k = torch.tensor(1000, dtype=torch.float64)
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 #PIKF层
 
+inv_2pi = 1.0/(2.0 * torch.pi)
+
+def _pikf_kernel(r: torch.Tensor) -> torch.Tensor:
+    return bessel_j0(k * r) * inv_2pi
+
+if hasattr(torch, 'compile'): # 融合乘法、贝塞尔函数与缩放为单个逐点核
+    _pikf_kernel = torch.compile(_pikf_kernel, mode='reduce-overhead')
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def pikf_assemble(col, src, k):
+        """
+        CPU 上的融合组装核：距离、J0（Numerical Recipes 有理逼近）与
+        1/(2*pi) 缩放在一个并行循环内完成，避免任何中间矩阵。
+        """
+        N = col.shape[0]
+        M = src.shape[0]
+        A = np.empty((N, M))
+        for i in prange(N):
+            for j in range(M):
+                dx = col[i, 0] - src[j, 0]
+                dy = col[i, 1] - src[j, 1]
+                ax = k * np.sqrt(dx*dx + dy*dy)
+                if ax < 8.0:
+                    y = ax*ax
+                    ans1 = 57568490574.0 + y*(-13362590354.0 + y*(651619640.7
+                        + y*(-11214424.18 + y*(77392.33017 + y*(-184.9052456)))))
+                    ans2 = 57568490411.0 + y*(1029532985.0 + y*(9494680.718
+                        + y*(59272.64853 + y*(267.8532712 + y))))
+                    ans = ans1/ans2
+                else:
+                    z = 8.0/ax
+                    y = z*z
+                    xx = ax - 0.785398164
+                    ans1 = 1.0 + y*(-0.1098628627e-2 + y*(0.2734510407e-4
+                        + y*(-0.2073370639e-5 + y*0.2093887211e-6)))
+                    ans2 = -0.1562499995e-1 + y*(0.1430488765e-3
+                        + y*(-0.6911147651e-5 + y*(0.7621095161e-6
+                        + y*(-0.934935152e-7))))
+                    ans = np.sqrt(0.636619772/ax)*(np.cos(xx)*ans1 - z*np.sin(xx)*ans2)
+                A[i, j] = ans * inv_2pi
+        return A
+
 class PIKF_layer(nn.Module):
     def __init__(self, source_nodes: torch.Tensor) -> None:
         super().__init__()
         self.source_nodes = source_nodes
 
     def kernel_func(self, input: torch.Tensor) -> torch.Tensor:
-        a = input[:, None, :] - self.source_nodes[None, :, :]
-        r = torch.sqrt((a[..., 0:1]**2 + a[..., 1:2]**2).view(input.shape[0], -1))
-        val = bessel_j0(k* r)/(2 * torch.pi)
-        return val
+        r = torch.cdist(input, self.source_nodes, p=2)
+        return _pikf_kernel(r)
 
     def forward(self, p: torch.Tensor) -> torch.Tensor:
 
         return self.kernel_func(p)
     
-source_nodes = sample_points_on_square(-2.5, 2.5, num_of_source)
+source_nodes = sample_points_on_square(-2.5, 2.5, num_of_source, device=device)
 pikf_layer = PIKF_layer(source_nodes)
 net_PIKFNN = nn.Sequential(
                            pikf_layer,
@@ -53,11 +100,13 @@ s = Solution(net_PIKFNN)
 
 #真解及边界条件
 
+k_sqrt2 = float(torch.sqrt(k**2/2))
+
 def solution(p:torch.Tensor) -> torch.Tensor:
 
     x = p[...,0:1]
     y = p[...,1:2]
-    return torch.sin(torch.sqrt(k**2/2) * x + torch.sqrt(k**2/2) * y)
+    return torch.sin(k_sqrt2 * (x + y))
 
 def dirichletBC(p:torch.Tensor) -> torch.Tensor:
     return solution(p)
@@ -66,13 +115,33 @@ def dirichletBC(p:torch.Tensor) -> torch.Tensor:
 
 start_time = time.time()
 
-col_bd = sample_points_on_square(-1, 1, num_of_col_bd)
-
-A = pikf_layer.kernel_func(col_bd).detach().numpy()
-b = dirichletBC(col_bd).detach().numpy()
-alpha = solve(A, b)
-net_PIKFNN[1].weight.data = torch.from_numpy(alpha).T
-del alpha 
+col_bd = sample_points_on_square(-1, 1, num_of_col_bd, device=device)
+
+if njit is not None and device.type == 'cpu':
+    A = torch.from_numpy(pikf_assemble(col_bd.numpy(), source_nodes.numpy(), float(k)))
+else:
+    A = pikf_layer.kernel_func(col_bd)
+b = dirichletBC(col_bd)
+
+# 当配置点与源点重合时 A 对称，可用 Cholesky 分解求解（浮点运算量为 LU 的一半）
+if A.shape[0] == A.shape[1] and torch.equal(A, A.mT):
+    try:
+        L = torch.linalg.cholesky(A)
+        alpha = torch.cholesky_solve(b, L)
+    except torch.linalg.LinAlgError:
+        alpha = torch.linalg.solve(A, b)
+else:
+    # 混合精度：单精度 LU 分解（带宽减半、SGEMM 吞吐加倍），
+    # 再做一步双精度迭代精化补回精度
+    A32 = A.to(torch.float32)
+    LU, piv = torch.linalg.lu_factor(A32)
+    alpha = torch.linalg.lu_solve(LU, piv, b.to(torch.float32)).double()
+    r = b - A @ alpha
+    alpha += torch.linalg.lu_solve(LU, piv, r.to(torch.float32)).double()
+    del A32, LU, piv
+net_PIKFNN[1].weight.data = alpha.T.cpu()
+pikf_layer.source_nodes = pikf_layer.source_nodes.cpu()
+del alpha
 
 end_time = time.time()     
 time_of_computation = end_time - start_time   
@@ -80,13 +149,14 @@ print("计算时间为：", time_of_computation, "秒")
 
 #计算L2相对误差
 test_nodes_sampler = ISampler(
-    1000, [[-1, 1], [-1, 1]], requires_grad=True)
+    1000, [[-1, 1], [-1, 1]], requires_grad=False)
 test_nodes = test_nodes_sampler.run()
 
-L2_error = torch.sqrt(
-            torch.sum((s(test_nodes) - solution(test_nodes))**2, dim = 0)\
-            /torch.sum(solution(test_nodes)**2, dim = 0)
-          )
+with torch.no_grad():
+    u_num = s(test_nodes)
+    u_exact = solution(test_nodes)
+L2_error = torch.linalg.norm(u_num - u_exact, dim=0)\
+           /torch.linalg.norm(u_exact, dim=0)
 print(f"L2_error: {L2_error}")
 
 #可视化数值解、真解以及两者偏差
@@ -61,8 +61,8 @@ def multiLine2Points(lineXY, distence):
     
     return newPoints
 
-def sample_points_on_square(left:float, right:float, num_points:int) ->torch.Tensor:
-    
+def sample_points_on_square(left:float, right:float, num_points:int, device=None) ->torch.Tensor:
+
     points = np.array(
                  [[left, left],
                   [left, right],
@@ -70,18 +70,19 @@ def sample_points_on_square(left:float, right:float, num_points:int) ->torch.Ten
                   [right, left]])
 
     newPoints = multiLine2Points(points, 4*(right-left)/num_points)
-    unique_rows, _ = torch.unique(torch.tensor(newPoints), dim=0, return_counts=True)
+    # 采样点直接放到目标设备上，后续去重等操作无需再搬运
+    unique_rows, _ = torch.unique(torch.tensor(newPoints, device=device), dim=0, return_counts=True)
     points = unique_rows.clone().detach()
-    
+
     return points
 
-def sample_points_on_circle(center_x:float, center_y:float, radius:float, num_points:int)->torch.Tensor:
-    
-    angles = torch.linspace(0, 2 * torch.pi, num_points+1)
+def sample_points_on_circle(center_x:float, center_y:float, radius:float, num_points:int, device=None)->torch.Tensor:
+
+    angles = torch.linspace(0, 2 * torch.pi, num_points+1, device=device)
     x = center_x + radius * torch.cos(angles)
     y = center_y + radius * torch.sin(angles)
     points = torch.stack((x, y), dim=1).to(torch.float64)
-    
+
     return points[:-1, ...]
 
 
@@ -311,10 +311,11 @@ class HexahedronMesh(Mesh3d):
 
     def uniform_refine(self, n=1):
         """
-        @brief 一致加密六面体网格 
+        @brief 一致加密六面体网格
         """
-        for i in range(n):
-            pass
+        raise NotImplementedError(
+            "uniform_refine is not implemented for the legacy HexahedronMesh;"
+            " use fealpy.mesh.HexahedronMesh instead.")
 
     def number_of_local_ipoints(p, celltype):
         if celltype=='edge':
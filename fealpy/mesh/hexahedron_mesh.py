@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import numpy as np
 from scipy.sparse import coo_matrix, csc_matrix, csr_matrix, spdiags, eye, tril, triu
 from scipy.sparse import triu, tril, find, hstack
@@ -5,6 +7,79 @@ from scipy.sparse import triu, tril, find, hstack
 from .mesh_base import Mesh, Plotable
 from .mesh_data_structure import Mesh3dDataStructure
 
+
+def _inv33(J):
+    """
+    @brief 批量 3x3 矩阵的解析逆（伴随矩阵除以行列式）
+
+    对 3x3 的小矩阵，逐元素的余子式公式比通用的 LAPACK 求逆快得多。
+    """
+    a, b, c = J[..., 0, 0], J[..., 0, 1], J[..., 0, 2]
+    d, e, f = J[..., 1, 0], J[..., 1, 1], J[..., 1, 2]
+    g, h, i = J[..., 2, 0], J[..., 2, 1], J[..., 2, 2]
+
+    A = e*i - f*h
+    D = f*g - d*i
+    G = d*h - e*g
+    det = a*A + b*D + c*G
+
+    inv = np.stack([
+        A, c*h - b*i, b*f - c*e,
+        D, a*i - c*g, c*d - a*f,
+        G, b*g - a*h, a*e - b*d], axis=-1).reshape(J.shape)
+    inv /= det[..., None, None]
+    return inv
+
+
+@lru_cache(maxsize=8)
+def _face_ipoint_tables(p):
+    """
+    @brief 缓存 p 次元四边形面上插值点的局部编号表
+    """
+    # (p+1)^2 个字典序排列的多重指标，一次生成
+    multiIndex = np.indices((p+1, p+1)).reshape(2, -1).T
+
+    dofidx = np.zeros((4, p+1), dtype=np.int_) #四条边上自由度的局部编号
+    dofidx[0], = np.where(multiIndex[:, 1]==0)
+    dofidx[1], = np.where(multiIndex[:, 0]==p)
+    dofidx[2], = np.where(multiIndex[:, 1]==p)
+    dofidx[3], = np.where(multiIndex[:, 0]==0)
+
+    indof = np.all(multiIndex>0, axis=-1)&np.all(multiIndex<p, axis=-1)
+    for arr in (multiIndex, dofidx, indof):
+        arr.setflags(write=False)
+    return multiIndex, dofidx, indof
+
+
+@lru_cache(maxsize=8)
+def _cell_ipoint_tables(p):
+    """
+    @brief 缓存 p 次元六面体单元上插值点的局部编号表
+    """
+    # (p+1)^3 个字典序排列的多重指标，一次生成
+    multiIndex = np.indices((p+1, p+1, p+1)).reshape(3, -1).T
+
+    dofidx = np.zeros((6, (p+1)**2), dtype=np.int_) #六个面上自由度的局部编号
+    dofidx[0], = np.where(multiIndex[:, 2]==0)
+    dofidx[1], = np.where(multiIndex[:, 2]==p)
+    dofidx[2], = np.where(multiIndex[:, 0]==0)
+    dofidx[3], = np.where(multiIndex[:, 0]==p)
+    dofidx[4], = np.where(multiIndex[:, 1]==0)
+    dofidx[5], = np.where(multiIndex[:, 1]==p)
+
+    lf2e = np.array([[0, 1, 2, 3], [8, 9, 10, 11],
+                     [3, 7, 11, 4], [1, 6, 9, 5],
+                     [0, 5, 8, 4], [2, 6, 10, 7]], dtype=np.int_)
+    lf2e = lf2e[:, [3, 0, 1, 2]]
+
+    multiIndex2d = multiIndex[:(p+1)**2, 1:]
+    multiIndex2d = np.c_[multiIndex2d, p-multiIndex2d]
+
+    indof = np.all(multiIndex>0, axis=-1)&np.all(multiIndex<p, axis=-1)
+    for arr in (multiIndex, dofidx, lf2e, multiIndex2d, indof):
+        arr.setflags(write=False)
+    return multiIndex, dofidx, lf2e, multiIndex2d, indof
+
 class HexahedronMeshDataStructure(Mesh3dDataStructure):
     # The following local data structure should be class properties
     localEdge = np.array([
@@ -30,6 +105,9 @@ class HexahedronMesh(Mesh, Plotable):
     """
     @brief 非结构六面体网格数据结构对象
     """
+    # 把单元的 8 个顶点重排成 (x, y, z) 张量积(字典序)的顶点次序
+    tensorOrder = np.array([0, 4, 3, 7, 1, 5, 2, 6])
+
     def __init__(self, node, cell):
         self.node = node
         NN = node.shape[0]
@@ -49,6 +127,25 @@ class HexahedronMesh(Mesh, Plotable):
         self.edge_shape_function = self._shape_function
         self.grad_edge_shape_function = self._grad_shape_function
 
+        # 拓扑查询缓存：ds.cell_to_face/face_to_edge 每次调用都会重建数组，
+        # 这里按网格缓存一份，网格加密时失效
+        self._cell2face = None
+        self._face2edge = None
+
+    def _clear_topology_cache(self):
+        self._cell2face = None
+        self._face2edge = None
+
+    def cell_to_face_cached(self):
+        if self._cell2face is None:
+            self._cell2face = self.ds.cell_to_face()
+        return self._cell2face
+
+    def face_to_edge_cached(self):
+        if self._face2edge is None:
+            self._face2edge = self.ds.face_to_edge()
+        return self._face2edge
+
     def ref_cell_measure(self):
         return 1.0
 
@@ -114,22 +211,22 @@ class HexahedronMesh(Mesh, Plotable):
             bc0 = bc[0].reshape(-1, 2) # (NQ0, 2)
             bc1 = bc[1].reshape(-1, 2) # (NQ1, 2)
             bc2 = bc[2].reshape(-1, 2) # (NQ2, 2)
-            bc = np.einsum('im, jn, ko->ijkmno', bc0, bc1, bc2).reshape(-1, 8) # (NQ0, NQ1, 2, 2, 2)
 
-            # node[cell].shape == (NC, 8, 3)
-            # bc.shape == (NQ, 8)
-            p = np.einsum('...j, cjk->...ck', bc, node[cell[:, [0, 4, 3, 7, 1, 5, 2, 6]]]) # (NQ, NC, 3)
+            # 把三个一维积分点的张量积与单元顶点的收缩合并为一次优化的 einsum，
+            # 避免先生成 (NQ, 8) 的中间数组
+            v = node[cell[:, self.tensorOrder]].reshape(-1, 2, 2, 2, 3)
+            p = np.einsum('im, jn, ko, cmnod->ijkcd', bc0, bc1, bc2, v,
+                    optimize=True).reshape(-1, cell.shape[0], 3) # (NQ, NC, 3)
 
         elif isinstance(bc, tuple) and len(bc) == 2:
             face = self.entity('face', index=index)
 
             bc0 = bc[0].reshape(-1, 2) # (NQ0, 2)
             bc1 = bc[1].reshape(-1, 2) # (NQ1, 2)
-            bc = np.einsum('im, jn->ijmn', bc0, bc1).reshape(-1, 4) # (NQ0, NQ1, 2, 2)
 
-            # node[cell].shape == (NC, 4, 2)
-            # bc.shape == (NQ, 4)
-            p = np.einsum('...j, cjk->...ck', bc, node[face[:, [0, 3, 1, 2]]]) # (NQ, NC, 2)
+            v = node[face[:, [0, 3, 1, 2]]].reshape(-1, 2, 2, node.shape[-1])
+            p = np.einsum('im, jn, fmnd->ijfd', bc0, bc1, v,
+                    optimize=True).reshape(-1, face.shape[0], node.shape[-1]) # (NQ, NF, GD)
         else:
             edge = self.entity('edge', index=index)[index]
             p = np.einsum('...j, ejk->...ek', bc, node[edge]) # (NQ, NE, 2)
@@ -145,6 +242,8 @@ class HexahedronMesh(Mesh, Plotable):
         """
         assert isinstance(bc, tuple)
         TD = len(bc)
+        if p == 1: # p=1 时一维形函数就是重心坐标本身，直接作张量积
+            return np.einsum('im, jn, ko->ijkmno', *bc).reshape(-1, 2**TD)
         phi = [self._shape_function(val, p=p) for val in bc]
         ldof = (p+1)**TD
         return np.einsum('im, jn, ko->ijkmno', phi[0], phi[1], phi[2]).reshape(-1, ldof)
@@ -167,9 +266,13 @@ class HexahedronMesh(Mesh, Plotable):
         assert isinstance(bc, tuple)
         TD = len(bc)
         Dlambda = np.array([-1, 1], dtype=self.ftype)
-        phi = self._shape_function(bc[0], p=p)
-        R = self._grad_shape_function(bc[0], p=p)
-        dphi = np.einsum('...ij, j->...i', R, Dlambda) # (..., ldof)
+        if p == 1: # p=1 特化：形函数即重心坐标，导数为常数 (-1, 1)
+            phi = bc[0]
+            dphi = np.broadcast_to(Dlambda, phi.shape)
+        else:
+            phi = self._shape_function(bc[0], p=p)
+            R = self._grad_shape_function(bc[0], p=p)
+            dphi = np.einsum('...ij, j->...i', R, Dlambda) # (..., ldof)
 
         n = phi.shape[0]**TD
         ldof = phi.shape[-1]**TD
@@ -182,7 +285,7 @@ class HexahedronMesh(Mesh, Plotable):
             gphi[..., 2] = np.einsum('im, jn, ko->ijkmno', phi, phi, dphi).reshape(-1, ldof)
             if variables == 'x':
                 J = self.jacobi_matrix(bc, index=index)
-                J = np.linalg.inv(J)
+                J = _inv33(J)
                 # J^{-T}\nabla_u phi
                 gphi = np.einsum('qcmn, qlm->qcln', J, gphi)
                 return gphi
@@ -210,9 +313,11 @@ class HexahedronMesh(Mesh, Plotable):
         entity = self.entity(TD, index=index)
         gphi = self.grad_shape_function(bc, p=1, variables='u')
         if TD == 3:
-            J = np.einsum( 'cim, qin->qcmn', node[entity[:, [0, 4, 3, 7, 1, 5, 2, 6]]], gphi)
+            v = node[entity[:, self.tensorOrder]] # (NC, 8, 3)
         elif TD == 2:
-            J = np.einsum( 'cim, qin->qcmn', node[entity[:, [0, 3, 1, 2]]], gphi)
+            v = node[entity[:, [0, 3, 1, 2]]] # (NF, 4, GD)
+        # 等价于 np.einsum('cim, qin->qcmn', v, gphi)，改写为批量矩阵乘以走 BLAS
+        J = np.matmul(v.swapaxes(-1, -2)[:, None], gphi[None]).swapaxes(0, 1)
         return J
 
     def first_fundamental_form(self, J):
@@ -255,7 +360,7 @@ class HexahedronMesh(Mesh, Plotable):
             cell = np.zeros((8*NC, 8), dtype=self.itype)
             c2n = self.entity('cell')
             c2e = self.ds.cell_to_edge() + NN
-            c2f = self.ds.cell_to_face() + (NN + NE)
+            c2f = self.cell_to_face_cached() + (NN + NE)
             c2c = np.arange(NC) + (NN + NE + NF)
 
             cell[0::8, 0] = c2n[:, 0]
@@ -332,6 +437,7 @@ class HexahedronMesh(Mesh, Plotable):
 
             self.node = node
             self.ds.reinit(NN+NE+NF+NC, cell)
+            self._clear_topology_cache()
 
 
     def number_of_local_ipoints(self, p, iptype='cell'):
@@ -438,14 +544,12 @@ class HexahedronMesh(Mesh, Plotable):
         gp = self.number_of_global_ipoints(p)
         ipoint = np.zeros([gp, 3], dtype=np.float64)
 
-        p04 = np.linspace(node[cell[:, 0]], node[cell[:, 4]], p+1, endpoint=True).swapaxes(0, 1)
-        p37 = np.linspace(node[cell[:, 3]], node[cell[:, 7]], p+1, endpoint=True).swapaxes(0, 1)
-        p15 = np.linspace(node[cell[:, 1]], node[cell[:, 5]], p+1, endpoint=True).swapaxes(0, 1)
-        p26 = np.linspace(node[cell[:, 2]], node[cell[:, 6]], p+1, endpoint=True).swapaxes(0, 1)
-
-        p0 = np.linspace(p04, p37, p+1, endpoint=True).swapaxes(0, 1).reshape(NC, -1, 3)
-        p1 = np.linspace(p15, p26, p+1, endpoint=True).swapaxes(0, 1).reshape(NC, -1, 3)
-        ipoint[c2ip] = np.linspace(p0, p1, p+1, endpoint=True).swapaxes(0, 1).reshape(NC, -1, 3)
+        # 用一次三线性张量积代替逐方向的 linspace 链
+        w = np.linspace(0, 1, p+1)
+        w = np.stack([1 - w, w], axis=-1) # (p+1, 2)
+        v = node[cell[:, self.tensorOrder]].reshape(NC, 2, 2, 2, 3)
+        ipoint[c2ip] = np.einsum('ia, jb, kc, qabcd->qijkd', w, w, w, v,
+                optimize=True).reshape(NC, -1, 3)
         return ipoint
 
     def face_to_ipoint(self, p, index=np.s_[:]):
@@ -457,29 +561,20 @@ class HexahedronMesh(Mesh, Plotable):
         NF = self.number_of_faces()
         edge = self.entity('edge')
         face = self.entity('face')
-        face2edge = self.ds.face_to_edge()
+        face2edge = self.face_to_edge_cached()
         edge2ipoint = self.edge_to_ipoint(p)
 
-        multiIndex = np.zeros([(p+1)**2, 2], dtype=np.int_)
-        multiIndex[:, 0] = np.repeat(np.arange(p+1), p+1)
-        multiIndex[:, 1] = np.tile(np.arange(p+1), p+1)
-
-        dofidx = np.zeros((4, p+1), dtype=np.int_) #四条边上自由度的局部编号
-        dofidx[0], = np.where(multiIndex[:, 1]==0)
-        dofidx[1], = np.where(multiIndex[:, 0]==p)
-        dofidx[2], = np.where(multiIndex[:, 1]==p)
-        dofidx[3], = np.where(multiIndex[:, 0]==0)
+        multiIndex, dofidx, indof = _face_ipoint_tables(p)
 
         face2ipoint = np.zeros([NF, (p+1)**2], dtype=np.int_)
         localEdge = np.array([[0, 1], [1, 2], [3, 2], [0, 3]], dtype=np.int_)
-        for i in range(4): #边上的自由度
-            ge = face2edge[:, i]
-            idx = np.where(face[:, localEdge[i, 0]] != edge[ge, 0])[0]
 
-            face2ipoint[:, dofidx[i]] = edge2ipoint[ge]
-            face2ipoint[idx[:, None], dofidx[i]] = edge2ipoint[ge[idx], ::-1]
+        # 边上的自由度：四条边一次性 gather，方向不一致的边翻转编号
+        e2ip = edge2ipoint[face2edge] # (NF, 4, p+1)
+        isReversed = face[:, localEdge[:, 0]] != edge[face2edge, 0] # (NF, 4)
+        e2ip = np.where(isReversed[..., None], e2ip[..., ::-1], e2ip)
+        face2ipoint[:, dofidx] = e2ip
 
-        indof = np.all(multiIndex>0, axis=-1)&np.all(multiIndex<p, axis=-1)
         face2ipoint[:, indof] = np.arange(NN+NE*(p-1),
                 NN+NE*(p-1)+NF*(p-1)**2).reshape(NF, -1)
         return face2ipoint
@@ -491,7 +586,7 @@ class HexahedronMesh(Mesh, Plotable):
 
         cell = self.entity('cell', index=index)
         if p == 1:
-            return cell[:, [0, 4, 3, 7, 1, 5, 2, 6]]
+            return cell[:, self.tensorOrder]
 
         NN = self.number_of_nodes()
         NE = self.number_of_edges()
@@ -501,48 +596,28 @@ class HexahedronMesh(Mesh, Plotable):
         edge = self.entity('edge')
         face = self.entity('face')
 
-        cell2face = self.ds.cell_to_face()
-        face2edge = self.ds.face_to_edge()
+        cell2face = self.cell_to_face_cached()
+        face2edge = self.face_to_edge_cached()
         cell2edge = self.ds.cell_to_edge()
 
         face2ipoint = self.face_to_ipoint(p)
 
-        multiIndex = np.zeros([(p+1)**3, 3], dtype=np.int_)
-        multiIndex[:, 0] = np.repeat(np.arange(p+1), (p+1)**2)
-        multiIndex[:, 1] = np.tile(np.repeat(np.arange(p+1), p+1), (p+1))
-        multiIndex[:, 2] = np.tile(np.arange(p+1), (p+1)**2)
-
-        dofidx = np.zeros((6, (p+1)**2), dtype=np.int_) #四条边上自由度的局部编号
-        dofidx[0], = np.where(multiIndex[:, 2]==0)
-        dofidx[1], = np.where(multiIndex[:, 2]==p)
-        dofidx[2], = np.where(multiIndex[:, 0]==0)
-        dofidx[3], = np.where(multiIndex[:, 0]==p)
-        dofidx[4], = np.where(multiIndex[:, 1]==0)
-        dofidx[5], = np.where(multiIndex[:, 1]==p)
+        multiIndex, dofidx, lf2e, multiIndex2d, indof = _cell_ipoint_tables(p)
 
         cell2ipoint = np.zeros([NC, (p+1)**3], dtype=np.int_)
-        lf2e = np.array([[0, 1, 2, 3], [8, 9, 10, 11],
-                         [3, 7, 11, 4], [1, 6, 9, 5],
-                         [0, 5, 8, 4], [2, 6, 10, 7]], dtype=np.int_)
+        face2edge = face2edge[:, [3, 0, 1, 2]]
 
-        multiIndex2d = multiIndex[:(p+1)**2, 1:]
-        multiIndex2d = np.c_[multiIndex2d, p-multiIndex2d]
+        # 面上的自由度：六个面一次性排序与 gather
+        gfe = face2edge[cell2face] # (NC, 6, 4)
+        lfe = cell2edge[:, lf2e] # (NC, 6, 4)
+        idx0 = np.argsort(gfe, axis=-1)
+        idx1 = np.argsort(np.argsort(lfe, axis=-1), axis=-1)
+        idx0 = np.take_along_axis(idx0, idx1, axis=-1) #(NC, 6, 4)
+        idx = multiIndex2d[:, idx0].transpose(1, 2, 0, 3) #(NC, 6, NQ, 4)
+
+        idx = idx[..., 0]*(p+1)+idx[..., 1] #(NC, 6, NQ)
+        cell2ipoint[:, dofidx] = face2ipoint[cell2face[..., None], idx]
 
-        lf2e = lf2e[:, [3, 0, 1, 2]]
-        face2edge = face2edge[:, [3, 0, 1, 2]]
-        for i in range(6): #面上的自由度
-            gfe = face2edge[cell2face[:, i]]
-            lfe = cell2edge[:, lf2e[i]]
-            idx0 = np.argsort(gfe, axis=-1)
-            idx1 = np.argsort(lfe, axis=-1)
-            idx1 = np.argsort(idx1, axis=-1)
-            idx0 = idx0[np.arange(NC)[:, None], idx1] #(NC, 4)
-            idx = multiIndex2d[:, idx0].swapaxes(0, 1) #(NC, NQ, 4)
-
-            idx = idx[..., 0]*(p+1)+idx[..., 1]
-            cell2ipoint[:, dofidx[i]] = face2ipoint[cell2face[:, i, None], idx]
-
-        indof = np.all(multiIndex>0, axis=-1)&np.all(multiIndex<p, axis=-1)
         cell2ipoint[:, indof] = np.arange(NN+NE*(p-1)+NF*(p-1)**2,
                 NN+NE*(p-1)+NF*(p-1)**2+NC*(p-1)**3).reshape(NC, -1)
         return cell2ipoint[index]
@@ -672,16 +747,12 @@ class HexahedronMesh(Mesh, Plotable):
         idx = np.arange(NN).reshape(nx+1, ny+1, nz+1)
         c = idx[:-1, :-1, :-1]
 
-        cell = np.zeros((NC, 8), dtype=np.int_)
         nyz = (ny + 1)*(nz + 1)
-        cell[:, 0] = c.flatten()
-        cell[:, 1] = cell[:, 0] + nyz
-        cell[:, 2] = cell[:, 1] + nz + 1
-        cell[:, 3] = cell[:, 0] + nz + 1
-        cell[:, 4] = cell[:, 0] + 1
-        cell[:, 5] = cell[:, 4] + nyz
-        cell[:, 6] = cell[:, 5] + nz + 1
-        cell[:, 7] = cell[:, 4] + nz + 1
+        # 每个单元 8 个顶点相对于单元左下角结点的全局编号偏移
+        offsets = np.array([
+            0, nyz, nyz + nz + 1, nz + 1,
+            1, nyz + 1, nyz + nz + 2, nz + 2], dtype=np.int_)
+        cell = c.reshape(-1, 1) + offsets
 
         if threshold is not None:
             bc = np.sum(node[cell, :], axis=1)/cell.shape[1]
@@ -1,6 +1,7 @@
 """
 Partitions of Units
 """
+import math
 from typing import Union, List, Callable, Any, Generic, TypeVar
 
 import torch
@@ -12,6 +13,32 @@ from .linear import Standardize
 PI = torch.pi
 
 
+def _try_jit(fn):
+    """
+    @brief Compile an element-wise kernel with TorchScript so its chain of\
+           comparisons, trig calls and multiplies fuses into fewer kernels.\
+           Falls back to the eager function if scripting is unavailable.
+    """
+    try:
+        return torch.jit.script(fn)
+    except Exception:
+        return fn
+
+
+@_try_jit
+def _leave_one_out_prod(t: Tensor) -> Tensor:
+    """
+    @brief Products along the last dim leaving one entry out: `out[..., i]`\
+           is the product of all entries except the i-th. Computed from left\
+           and right cumulative scans, so zeros in `t` are handled exactly.
+    """
+    L = torch.cumprod(t, dim=-1)
+    R = torch.flip(torch.cumprod(torch.flip(t, [-1]), dim=-1), [-1])
+    ones = torch.ones_like(t[..., :1])
+    return torch.cat([ones, L[..., :-1]], dim=-1)\
+         * torch.cat([R[..., 1:], ones], dim=-1)
+
+
 class _PoU_Fn(Module):
     """
     Base class for PoU functions. These functions apply on each dimension of inputs,
@@ -22,7 +49,10 @@ class _PoU_Fn(Module):
     _instance = None
     def __new__(cls):
         if cls._instance is None:
-            cls._instance = object.__new__(cls)
+            inst = object.__new__(cls)
+            # dispatch table for dn(): order k maps to _derivs[k]
+            inst._derivs = (inst.forward, inst.d1, inst.d2, inst.d3, inst.d4)
+            cls._instance = inst
         return cls._instance
 
     def forward(self, x: Tensor):
@@ -38,16 +68,12 @@ class _PoU_Fn(Module):
         """
         @brief order-specified derivative
         """
-        if order == 0:
-            return self.forward(x)
-        elif order >= 1:
-            fn = getattr(self, 'd'+str(order), None)
-            if fn is None:
-                raise NotImplementedError(f"{order}-order derivative has not been implemented.")
-            else:
-                return fn(x)
-        else:
+        if order < 0:
             raise ValueError(f"order can not be negative, but got {order}.")
+        try:
+            return self._derivs[order](x)
+        except IndexError:
+            raise NotImplementedError(f"{order}-order derivative has not been implemented.")
 
     def d1(self, x: Tensor):
         """
@@ -107,69 +133,92 @@ class PoU(Module):
         """
         raise NotImplementedError
 
+    def compute_all(self, x: Tensor, order: int=2):
+        """
+        @brief Return the tuple (value, gradient, hessian) in one call, so\
+               that subclasses can share intermediate results between the\
+               three. The hessian entry is None when `order < 2`.
+        """
+        hess = self.hessian(x) if order >= 2 else None
+        return self(x), self.gradient(x), hess
+
 
 class PoUA(PoU):
     def forward(self, x: Tensor): # (..., d) -> (..., 1)
-        flag = (-1 <= x) * (x <= 1)
-        flag = torch.prod(flag, dim=-1, keepdim=self.keepdim)
+        flag = ((x >= -1) & (x <= 1)).all(dim=-1, keepdim=self.keepdim)
         return flag.to(dtype=x.dtype)
         # Here we cast the data type after the operation for lower memory usage.
 
     def flag(self, x: Tensor):
-        flag = ((x >= -1) * (x <= 1))
-        return torch.prod(flag, dim=-1, dtype=torch.bool)
+        return ((x >= -1) & (x <= 1)).all(dim=-1)
 
     def gradient(self, x: Tensor):
         N, GD = x.shape[0], x.shape[-1]
-        return torch.tensor(0, dtype=x.dtype, device=x.device).broadcast_to(N, GD)
+        # stride-0 view of a scalar zero: no (N, GD) buffer is allocated
+        return x.new_zeros(()).expand(N, GD)
 
     def hessian(self, x: Tensor):
         N, GD = x.shape[0], x.shape[-1]
-        return torch.tensor(0, dtype=x.dtype, device=x.device).broadcast_to(N, GD, GD)
+        return x.new_zeros(()).expand(N, GD, GD)
 
     def derivative(self, x: Tensor, *idx: int):
         order = len(idx)
         if order == 0:
             return self.forward(x)
         else:
-            N, _ = x.shape[0], x.shape[-1]
-            return torch.tensor(0, dtype=x.dtype, device=x.device).broadcast_to(N, 1)
+            return x.new_zeros(()).expand(x.shape[0], 1)
 
 
 ### Sin-style PoU function & module
 
+@_try_jit
+def _pou_sin_band_sign(x: Tensor) -> Tensor:
+    """
+    @brief +1 on the left transition band [-1.25, -0.75), -1 on the right\
+           band [0.75, 1.25) and 0 elsewhere. The two support flags are\
+           evaluated once here and shared by all derivatives; the half-\
+           open boundaries match the original per-method masks exactly.
+    """
+    f1 = (x >= -1.25) & (x < -0.75)
+    f3 = (x >= 0.75) & (x < 1.25)
+    return f1.to(dtype=x.dtype) - f3.to(dtype=x.dtype)
+
+
+@_try_jit
+def _pou_sin_value(x: Tensor) -> Tensor:
+    f2 = (x >= -0.75) & (x < 0.75)
+    bs = _pou_sin_band_sign(x)
+    return f2.to(dtype=x.dtype) + 0.5*(torch.abs(bs) + torch.sin(2*math.pi*x)*bs)
+
+
+@_try_jit
+def _pou_sin_d1(x: Tensor) -> Tensor:
+    return math.pi * torch.cos(2*math.pi*x) * _pou_sin_band_sign(x)
+
+
+@_try_jit
+def _pou_sin_d2(x: Tensor) -> Tensor:
+    return -2*math.pi**2 * torch.sin(2*math.pi*x) * _pou_sin_band_sign(x)
+
+
 class _PoU_Sin_Fn(_PoU_Fn):
     def forward(self, x: Tensor):
-        f1 = (-1.25 <= x) * (x < -0.75)
-        f2 = (-0.75 <= x) * (x < 0.75)
-        f3 = (0.75 <= x) * (x < 1.25)
-        l1 = 0.5 * (1 + sin(2*PI*x)) * f1
-        l2 = f2.to(dtype=x.dtype)
-        l3 = 0.5 * (1 - sin(2*PI*x)) * f3
-        return l1 + l2 + l3
+        return _pou_sin_value(x)
 
     def flag(self, x: Tensor):
-        return (x >= -1.25) * (x <= 1.25)
+        return (x >= -1.25) & (x <= 1.25)
 
     def d1(self, x: Tensor):
-        f1 = (-1.25 <= x) * (x < -0.75)
-        f3 = (0.75 <= x) * (x < 1.25)
-        return PI * cos(2*PI*x) * f1 - PI * cos(2*PI*x) * f3
+        return _pou_sin_d1(x)
 
     def d2(self, x: Tensor):
-        f1 = (-1.25 <= x) * (x < -0.75)
-        f3 = (0.75 <= x) * (x < 1.25)
-        return -2*PI**2 * sin(2*PI*x) * f1 + 2*PI**2 * sin(2*PI*x) * f3
+        return _pou_sin_d2(x)
 
     def d3(self, x: Tensor):
-        f1 = (-1.25 <= x) * (x < -0.75)
-        f3 = (0.75 <= x) * (x < 1.25)
-        return -4*PI**3 * cos(2*PI*x) * f1 + 4*PI**3 * cos(2*PI*x) * f3
+        return -4*PI**3 * cos(2*PI*x) * _pou_sin_band_sign(x)
 
     def d4(self, x: Tensor):
-        f1 = (-1.25 <= x) * (x < -0.75)
-        f3 = (0.75 <= x) * (x < 1.25)
-        return 8*PI**4 * sin(2*PI*x) * f1 - 8*PI**4 * sin(2*PI*x) * f3
+        return 8*PI**4 * sin(2*PI*x) * _pou_sin_band_sign(x)
 
 
 class PoUSin(PoU):
@@ -185,45 +234,59 @@ class PoUSin(PoU):
 
     def flag(self, x: Tensor):
         # As bool type is used in indexing, keepdim is set to False.
-        return torch.prod(self.func.flag(x), dim=-1, dtype=torch.bool)
+        return self.func.flag(x).all(dim=-1)
 
     def gradient(self, x: Tensor):
+        # grad_i = p'_i * prod_{j != i} p_j, vectorized over all dims at once.
         pg = self.func.d1(x)
         p = self.func(x)
-        N, GD = x.shape[0], x.shape[-1]
-        grad = torch.ones((N, GD), dtype=x.dtype)
-        for i in range(GD):
-            element = torch.zeros((N, GD), dtype=x.dtype)
-            element[:] = p[:, i][:, None]
-            element[:, i] = pg[:, i]
-            grad *= element
-        return grad
+        return _leave_one_out_prod(p) * pg
+
+    @staticmethod
+    def _assemble_hessian(p: Tensor, pg: Tensor, ph: Tensor, loo: Tensor):
+        # H_ij = p'_i * p'_j * prod_{k != i,j} p_k for i != j, and
+        # H_ii = p''_i * prod_{k != i} p_k, assembled without a GD loop.
+        GD = p.shape[-1]
+        # leave-two-out products: mask out axes i and j, multiply the rest
+        d = torch.arange(GD, device=p.device)
+        keep = (d[None, None, :] != d[:, None, None])\
+             & (d[None, None, :] != d[None, :, None])          # (GD, GD, GD)
+        loo2 = torch.where(keep, p[..., None, None, :],
+                           p.new_ones(1)).prod(dim=-1)
+        hes = loo2 * pg[..., :, None] * pg[..., None, :]
+        hes.diagonal(dim1=-2, dim2=-1).copy_(ph * loo)
+        return hes
 
     def hessian(self, x: Tensor):
-        ph = self.func.d2(x)
-        pg = self.func.d1(x)
         p = self.func(x)
-        N, GD = x.shape[0], x.shape[-1]
-        hes = torch.ones((N, GD, GD), dtype=x.dtype)
-        for i in range(GD):
-            element = torch.zeros((N, GD, GD), dtype=x.dtype)
-            element[:] = p[:, i][:, None, None]
-            element[:, i, :] = pg[:, i][:, None]
-            element[:, :, i] = pg[:, i][:, None]
-            element[:, i, i] = ph[:, i]
-            hes *= element
-        return hes
+        return self._assemble_hessian(p, self.func.d1(x), self.func.d2(x),
+                                      _leave_one_out_prod(p))
+
+    def compute_all(self, x: Tensor, order: int=2):
+        # value, gradient and hessian share the 1-d evaluations and the
+        # leave-one-out products; everything is computed exactly once
+        p = self.func(x)
+        val = torch.prod(p, dim=-1, keepdim=self.keepdim)
+        pg = self.func.d1(x)
+        loo = _leave_one_out_prod(p)
+        grad = loo * pg
+        if order < 2:
+            return val, grad, None
+        return val, grad, self._assemble_hessian(p, pg, self.func.d2(x), loo)
 
     def derivative(self, x: Tensor, *idx: int):
-        N = x.shape[0]
-        os = [0, ] * x.shape[-1]
+        GD = x.shape[-1]
+        os = [0, ] * GD
         for i in idx:
             os[i] += 1
 
-        ret = torch.ones((N, 1), dtype=x.dtype, device=x.device)
-        for i in range(x.shape[-1]):
-            ret *= self.func.dn(x[:, i:i+1], order=os[i])
-        return ret
+        # evaluate each required derivative order once on the full input,
+        # then pick the order assigned to every dimension and multiply
+        orders = sorted(set(os))
+        vals = torch.stack([self.func.dn(x, order=k) for k in orders], dim=0)
+        pick = torch.tensor([orders.index(o) for o in os], device=x.device)
+        chosen = vals[pick, :, torch.arange(GD, device=x.device)]
+        return chosen.prod(dim=0).unsqueeze(-1)
 
 
 ##################################################
@@ -250,31 +313,37 @@ class PoULocalSpace(FunctionSpaceBase, Generic[_FS]):
         return self.space.basis(p) * self.pou(p)
 
     def grad_basis(self, p: Tensor) -> Tensor:
+        # These products are plain outer broadcasts, so they are written with
+        # unsqueeze/mul instead of einsum to skip the subscript dispatch.
         space = self.space
-        ret = torch.einsum("nd, nf -> nfd", self.pou.gradient(p), space.basis(p))
-        ret += self.pou(p)[..., None] * space.grad_basis(p)
+        pv, pg, _ = self.pou.compute_all(p, order=1)
+        ret = pg[:, None, :] * space.basis(p)[..., None]
+        ret += pv[..., None] * space.grad_basis(p)
         return ret
 
     def hessian_basis(self, p: Tensor) -> Tensor:
         space = self.space
-        ret = torch.einsum("nxy, nf -> nfxy", self.pou.hessian(p), space.basis(p))
-        cross = torch.einsum("nx, nfy -> nfxy", self.pou.gradient(p),
-                             space.grad_basis(p))
+        pv, pg, phess = self.pou.compute_all(p)
+        ret = phess[:, None, :, :] * space.basis(p)[..., None, None]
+        cross = pg[:, None, :, None] * space.grad_basis(p)[..., None, :]
         ret += cross + torch.transpose(cross, -1, -2)
-        ret += self.pou(p)[..., None, None] * space.hessian_basis(p)
+        ret += pv[..., None, None] * space.hessian_basis(p)
         return ret
 
     def laplace_basis(self, p: Tensor, coef=None) -> Tensor:
         space = self.space
+        pv, pg, phess = self.pou.compute_all(p)
+        hd = torch.diagonal(phess, dim1=-2, dim2=-1)
         if coef is None:
-            ret = torch.einsum("ndd, nf -> nf", self.pou.hessian(p), space.basis(p))
-            ret += 2 * torch.einsum("nd, nfd -> nf", self.pou.gradient(p),
-                                    space.grad_basis(p))
+            ret = hd.sum(dim=-1, keepdim=True) * space.basis(p)
+            ret += 2 * (pg[:, None, :] * space.grad_basis(p)).sum(dim=-1)
         else:
-            ret = torch.einsum("ndd, nf, d -> nf", self.pou.hessian(p), space.basis(p), coef)
-            ret += 2 * torch.einsum("nd, nfd, d -> nf", self.pou.gradient(p),
-                                    space.grad_basis(p), coef)
-        ret += self.pou(p) * space.laplace_basis(p, coef=coef)
+            # fold coef into the small (N, GD) factors first, then contract;
+            # this avoids the 3-operand einsum path search on every call
+            ret = (hd*coef).sum(dim=-1, keepdim=True) * space.basis(p)
+            ret += 2 * ((pg*coef)[:, None, :]
+                        * space.grad_basis(p)).sum(dim=-1)
+        ret += pv * space.laplace_basis(p, coef=coef)
         return ret
 
     def derivative_basis(self, p: Tensor, *idx: int) -> Tensor:
@@ -328,14 +397,20 @@ def assemble(func: Callable[..., Tensor]):
         M = self.number_of_basis()
         ret = torch.zeros((N, M), dtype=self.dtype, device=self.device)
         std = self.std(p)
-        basis_cursor = 0
+        # Every partition shares a single PoU object whose flag reduces the
+        # last axis only, so the support flags of all partitions are obtained
+        # by one batched call on the (N, #parts, GD) standardized coordinates
+        # instead of one small kernel per partition.
+        flags = self.partitions[0].flag(std)
 
         for idx, part in enumerate(self.partitions):
-            NF = part.number_of_basis()
             x = std[:, idx, :]
-            flag = part.flag(x)
-            ret[flag, basis_cursor:basis_cursor+NF] += func(self, idx, x[flag, ...], *args, **kwargs)
-            basis_cursor += NF
+            row = torch.nonzero(flags[:, idx], as_tuple=True)[0]
+            val = func(self, idx, x[row, ...], *args, **kwargs)
+            # write through a column view; index_add_ scatters the rows
+            # without building the (row, col) mesh a masked += would need
+            # (the cast keeps the old masked-assignment promotion rule)
+            ret[:, self._basis_slices[idx]].index_add_(0, row, val.to(dtype=ret.dtype))
         return ret
     return wrapper
 
@@ -366,6 +441,15 @@ class PoUSpace(FunctionSpaceBase, Generic[_FS]):
             self.partitions.append(part)
             self.add_module(f"part_{i}", part)
 
+        # per-partition column ranges in the global basis, fixed after init
+        slices = []
+        start = 0
+        for part in self.partitions:
+            stop = start + part.number_of_basis()
+            slices.append(slice(start, stop, None))
+            start = stop
+        self._basis_slices = tuple(slices)
+
         if print_status:
             print(self.status_string)
 
@@ -379,7 +463,7 @@ class PoUSpace(FunctionSpaceBase, Generic[_FS]):
         return self.std.centers.shape[0]
 
     def number_of_basis(self):
-        return sum(p.number_of_basis() for p in self.partitions)
+        return self._basis_slices[-1].stop if self._basis_slices else 0
 
     def partition_basis_slice(self, idx: int):
         """
@@ -391,9 +475,7 @@ class PoUSpace(FunctionSpaceBase, Generic[_FS]):
         assert idx >= 0
         assert idx < self.number_of_partitions()
 
-        start = sum((p.number_of_basis() for p in self.partitions[:idx]), 0)
-        stop = start + self.partitions[idx].number_of_basis()
-        return slice(start, stop, None)
+        return self._basis_slices[idx]
 
     @assemble
     def basis(self, idx: int, p: Tensor) -> Tensor:
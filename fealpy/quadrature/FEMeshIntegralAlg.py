@@ -1,10 +1,42 @@
 import numpy as np
+from functools import lru_cache
 from scipy.sparse import csr_matrix, coo_matrix
 import multiprocessing as mp
 from multiprocessing.pool import ThreadPool as Pool
 from ..decorator import timer
 
 
+@lru_cache(maxsize=64)
+def _einsum_path(subscripts, *shapes):
+    """
+    @brief 按 (下标, 形状) 缓存 einsum 的最优收缩路径. 组装时同一网格上的
+           形状在迭代中保持不变, 路径搜索只需做一次.
+    """
+    dummies = [np.broadcast_to(np.empty((1, ), dtype=np.float64), s)
+               for s in shapes]
+    return np.einsum_path(subscripts, *dummies, optimize='optimal')[0]
+
+
+def _einsum_opt(subscripts, *operands):
+    """
+    @brief 等价于 np.einsum(..., optimize=True), 但收缩路径按操作数形状缓存.
+    """
+    path = _einsum_path(subscripts, *(op.shape for op in operands))
+    return np.einsum(subscripts, *operands, optimize=path)
+
+
+def _weighted_reduce(ws, val, measure):
+    """
+    @brief 在积分点轴上做加权求和, 再乘以实体测度. 等价于
+           np.einsum('q, qe..., e->e...', ws, val, measure), 但通过
+           tensordot 直接调用 BLAS, 省去每次调用的下标解析与路径搜索.
+           ws 可以是多维的张量积权重, 此时约掉前 ws.ndim 个轴.
+    """
+    nq = ws.ndim
+    e = np.tensordot(ws, val, axes=(tuple(range(nq)), tuple(range(nq))))
+    return e*measure.reshape(measure.shape + (1, )*(e.ndim - 1))
+
+
 class FEMeshIntegralAlg():
     def __init__(self, mesh, q, cellmeasure=None):
         """
@@ -84,7 +116,7 @@ class FEMeshIntegralAlg():
             elif f.shape == (GD, GD):
                 e = self.cellmeasure[:, None, None]*f
             else:
-                e = np.einsum('q, qc..., c->c...', ws, f, self.cellmeasure)
+                e = _weighted_reduce(ws, f, self.cellmeasure)
 
         if celltype == False:
             e = np.power(np.sum(e), 1/power)
@@ -136,7 +168,7 @@ class FEMeshIntegralAlg():
             elif f.shape == (GD, GD): # 常矩阵函数
                 e = self.cellmeasure[:, None, None]*f
             else:
-                e = np.einsum('q, qi..., i->i...', ws, f, measure)
+                e = _weighted_reduce(ws, f, measure)
         return e
 
     def edge_integral(self, f, q=None):
@@ -164,7 +196,7 @@ class FEMeshIntegralAlg():
             elif f.shape == (GD, GD):
                 e = self.edgemeasure[:, None, None]*f
             else:
-                e = np.einsum('q, qe..., e->e...', ws, f, self.edgemeasure)
+                e = _weighted_reduce(ws, f, self.edgemeasure)
         return e
 
     def face_integral(self, f, q=None):
@@ -193,7 +225,7 @@ class FEMeshIntegralAlg():
             elif f.shape == (GD, GD): # 常矩阵函数
                 e = self.facemeasure[:, None, None]*f
             else:
-                e = np.einsum('q, qf..., f->f...', ws, f, self.facemeasure)
+                e = _weighted_reduce(ws, f, self.facemeasure)
         return e
 
     def cell_integral(self, f, q=None, power=None):
@@ -224,7 +256,7 @@ class FEMeshIntegralAlg():
             elif f.shape == (GD, GD): # 常矩阵函数
                 e = self.cellmeasure[:, None, None]*f
             else:
-                e = np.einsum('q, qc..., c->c...', ws, f, self.cellmeasure)
+                e = _weighted_reduce(ws, f, self.cellmeasure)
         return e
 
 
@@ -385,8 +417,8 @@ class FEMeshIntegralAlg():
             phi1 = phi0
 
         if c is None:
-            M = np.einsum('i, ijk..., ijm..., j->jkm', ws, phi0, phi1,
-                    self.cellmeasure, optimize=True)
+            M = _einsum_opt('i, ijk..., ijm..., j->jkm', ws, phi0, phi1,
+                    self.cellmeasure)
         else: 
             if callable(c):
                 if c.coordtype == 'barycentric':
@@ -395,28 +427,28 @@ class FEMeshIntegralAlg():
                     c = c(ps)
 
             if isinstance(c, (int, float)):
-                M = np.einsum('i, ijk..., ijm..., j->jkm', c*ws, phi0, phi1,
-                        self.cellmeasure, optimize=True)
+                M = _einsum_opt('i, ijk..., ijm..., j->jkm', c*ws, phi0, phi1,
+                        self.cellmeasure)
             elif isinstance(c, np.ndarray): 
                 if c.shape == (GD, GD): # constant diffusion coefficient
                     phi0 = np.einsum('mn, ijkn->ijkm', c, phi0)
-                    M = np.einsum('i, ijkl, ijml, j->jkm', ws, phi0, phi1,
-                            self.cellmeasure, optimize=True)
+                    M = _einsum_opt('i, ijkl, ijml, j->jkm', ws, phi0, phi1,
+                            self.cellmeasure)
                 elif c.shape == (GD, ): # constant convection coefficient
                     phi0 = np.einsum('m, ijkm->ijk', c, phi0)
-                    M = np.einsum('i, ijk, ijm, j->jkm', ws, phi0, phi1,
-                            self.cellmeasure, optimize=True)
+                    M = _einsum_opt('i, ijk, ijm, j->jkm', ws, phi0, phi1,
+                            self.cellmeasure)
                 elif len(c.shape) == 2: # (NQ, NC)
-                    M = np.einsum('i, ij, ijk..., ijm..., j->jkm', ws, c, phi0, phi1,
-                            self.cellmeasure, optimize=True)
+                    M = _einsum_opt('i, ij, ijk..., ijm..., j->jkm', ws, c, phi0, phi1,
+                            self.cellmeasure)
                 elif len(c.shape) == 3: # (NQ, NC, GD)
                     phi0 = np.einsum('ijm, ijkm->ijk', c, phi0)
-                    M = np.einsum('i, ijk, ijm, j->jkm', ws, phi0, phi1,
-                            self.cellmeasure, optimize=True)
+                    M = _einsum_opt('i, ijk, ijm, j->jkm', ws, phi0, phi1,
+                            self.cellmeasure)
                 elif len(c.shape) == 4: # (NQ, NC, GD, GD)
                     phi0 = np.einsum('ijmn, ijkn->ijkm', c, phi0)
-                    M = np.einsum('i, ijkl, ijml, j->jkm', ws, phi0, phi1,
-                            self.cellmeasure, optimize=True)
+                    M = _einsum_opt('i, ijkl, ijml, j->jkm', ws, phi0, phi1,
+                            self.cellmeasure)
 
         if cell2dof0 is None: # 仅组装单元矩阵 
             return M
@@ -539,12 +571,12 @@ class FEMeshIntegralAlg():
             phi1 = phi0
 
         if c is None:
-            M = np.einsum('i, ijk..., ijm..., j->jkm', ws, phi0, phi1,
-                    self.cellmeasure, optimize=True)
+            M = _einsum_opt('i, ijk..., ijm..., j->jkm', ws, phi0, phi1,
+                    self.cellmeasure)
         else: # TODO: make here work
             if isinstance(c, (int, float)):
-                M = np.einsum('i, ijk..., ijm..., j->jkm', c*ws, phi0, phi1,
-                        self.cellmeasure, optimize=True)
+                M = _einsum_opt('i, ijk..., ijm..., j->jkm', c*ws, phi0, phi1,
+                        self.cellmeasure)
             elif callable(c):
                 if c.coordtype == 'barycentric':
                     c = c(bcs)
@@ -552,19 +584,19 @@ class FEMeshIntegralAlg():
                     c = c(ps)
 
                 if isinstance(c, (int, float)):
-                    M = np.einsum('i, ijk..., ijm..., j->jkm', c*ws, phi0, phi1,
-                            self.cellmeasure, optimize=True)
+                    M = _einsum_opt('i, ijk..., ijm..., j->jkm', c*ws, phi0, phi1,
+                            self.cellmeasure)
                 elif isinstance(c, np.ndarray):
                     # user should make `c` have the correct shape
                     if len(c.shape) == 2:
-                        M = np.einsum('i, ij, ijk..., ijm..., j->jkm', ws, c, phi0, phi1,
-                                self.cellmeasure, optimize=True)
+                        M = _einsum_opt('i, ij, ijk..., ijm..., j->jkm', ws, c, phi0, phi1,
+                                self.cellmeasure)
                     elif len(c.shape) == 3:
-                        M = np.einsum('i, ijk..., ijk..., ijm..., j->jkm', ws, c[:, :, None, :], phi0, phi1,
-                                self.cellmeasure, optimize=True)
+                        M = _einsum_opt('i, ijk..., ijk..., ijm..., j->jkm', ws, c[:, :, None, :], phi0, phi1,
+                                self.cellmeasure)
                     elif len(c.shape) == 4:
-                        M = np.einsum('i, ijkab, ijkb, ijma, j->jkm', ws, c[:, :, None, :, :], phi0, phi1,
-                                self.cellmeasure, optimize=True)
+                        M = _einsum_opt('i, ijkab, ijkb, ijma, j->jkm', ws, c[:, :, None, :, :], phi0, phi1,
+                                self.cellmeasure)
 
         if cell2dof0 is None: # just construct cell matrix
             return M
@@ -705,14 +737,14 @@ class FEMeshIntegralAlg():
         else:
             ps = self.mesh.bc_to_point(bcs)  # (NQ, NC, 2)
             val = u(ps)
-        dim = len(ws.shape)
-        s0 = 'abcde'
-        s1 = '{}, {}j..., j->j...'.format(s0[0:dim], s0[0:dim])
-        e = np.einsum(s1, ws, val, self.cellmeasure)
         if celltype is True:
-            return e
-        else:
-            return e.sum()
+            return _weighted_reduce(ws, val, self.cellmeasure)
+        # 只要总积分时, 把单元测度并入积分权重, 一次 tensordot 约掉全部
+        # 求和轴, 不再生成逐单元的中间数组
+        w = ws.reshape(ws.shape + (1, ))*self.cellmeasure
+        nw = w.ndim
+        e = np.tensordot(w, val, axes=(tuple(range(nw)), tuple(range(nw))))
+        return e.sum()
 
     def L2_norm(self, uh, celltype=False):
         def f(x):
@@ -734,26 +766,24 @@ class FEMeshIntegralAlg():
             return np.sqrt(e)
 
     def L1_error(self, u, uh, celltype=False):
-        def f(x):
-            xx = self.mesh.bc_to_point(x)
-            return np.abs(u(xx) - uh(x))
-        e = self.integral(f, celltype=celltype)
+        qf = self.integrator
+        ps = self.mesh.bc_to_point(qf.quadpts)
+        e = _weighted_reduce(qf.weights, np.abs(u(ps) - uh(qf.quadpts)),
+                self.cellmeasure)
         if celltype is False:
             return e.sum()
         else:
             return e
-        return
 
     def L2_error(self, u, uh, celltype=False):
-        def f(bc):
-            xx = self.mesh.bc_to_point(bc)
-            return (u(xx) - uh(bc))**2
-        e = self.integral(f, celltype=celltype)
+        qf = self.integrator
+        ps = self.mesh.bc_to_point(qf.quadpts)
+        e = _weighted_reduce(qf.weights, (u(ps) - uh(qf.quadpts))**2,
+                self.cellmeasure)
         if celltype is False:
             return np.sqrt(e.sum())
         else:
             return np.sqrt(e)
-        return 
 
     def L2_error_uI_uh(self, uI, uh, celltype=False):
         def f(x):
@@ -766,12 +796,11 @@ class FEMeshIntegralAlg():
         return 
 
     def Lp_error(self, u, uh, p, celltype=False):
-        def f(x):
-            xx = self.mesh.bc_to_point(x)
-            return np.abs(u(xx) - uh(x))**p
-        e = self.integral(f, celltype=celltype)
+        qf = self.integrator
+        ps = self.mesh.bc_to_point(qf.quadpts)
+        e = _weighted_reduce(qf.weights, np.abs(u(ps) - uh(qf.quadpts))**p,
+                self.cellmeasure)
         if celltype is False:
             return e.sum()**(1/p)
         else:
             return e**(1/p)
-        return 